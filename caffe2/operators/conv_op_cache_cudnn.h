@@ -18,6 +18,8 @@
 #define CAFFE2_OPERATORS_CONV_OP_CACHE_H_
 
 #include <functional>
+#include <map>
+#include <mutex>
 #include <unordered_map>
 #include <vector>
 
@@ -66,5 +68,61 @@ T AlgorithmsCache<T>::getAlgorithm(
 
   return hash_[seed];
 }
+
+// A process-wide algorithm cache shared by all operators that use the same
+// algorithm type T, so that identical convolutions only pay for the
+// exhaustive search once. Callers are responsible for folding every argument
+// that influences the algorithm choice into the two key vectors.
+//
+// Unlike AlgorithmsCache, entries are keyed on the full key vectors rather
+// than on their hash, since a collision here would hand an algorithm to an
+// unrelated operator. The lock is not held while generatingFunc runs, so
+// searches on different GPUs can proceed in parallel.
+template <typename T>
+class SharedAlgorithmsCache {
+ public:
+  static T getAlgorithm(
+      const std::vector<TIndex>& bottom,
+      const std::vector<TIndex>& desc,
+      std::function<T()> generatingFunc) {
+    if (bottom.empty() && desc.empty()) {
+      return generatingFunc();
+    }
+
+    // Prefix with the size of bottom so that the split point between the
+    // two vectors is part of the key.
+    std::vector<TIndex> key;
+    key.reserve(bottom.size() + desc.size() + 1);
+    key.push_back(bottom.size());
+    key.insert(key.end(), bottom.begin(), bottom.end());
+    key.insert(key.end(), desc.begin(), desc.end());
+
+    {
+      std::lock_guard<std::mutex> guard(mutex());
+      auto it = cache().find(key);
+      if (it != cache().end()) {
+        return it->second;
+      }
+    }
+
+    T value = generatingFunc();
+
+    std::lock_guard<std::mutex> guard(mutex());
+    // If another operator finished the same search first, keep its result
+    // so that every caller sees the same algorithm.
+    return cache().emplace(std::move(key), value).first->second;
+  }
+
+ private:
+  static std::mutex& mutex() {
+    static std::mutex mutex;
+    return mutex;
+  }
+
+  static std::map<std::vector<TIndex>, T>& cache() {
+    static std::map<std::vector<TIndex>, T> cache;
+    return cache;
+  }
+};
 }
 #endif
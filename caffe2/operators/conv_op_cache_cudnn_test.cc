@@ -61,4 +61,30 @@ TEST(AlgorithmsCacheTest, KeysDifferIfOneVectorIsEmpty) {
   EXPECT_EQ(res2, 10);
 }
 
+TEST(SharedAlgorithmsCacheTest, SharesAcrossCallers) {
+  int result = SharedAlgorithmsCache<int>::getAlgorithm(
+      std::vector<TIndex>(1, 3), std::vector<TIndex>(2, 7), []() { return 5; });
+  EXPECT_EQ(result, 5);
+
+  int res2 = SharedAlgorithmsCache<int>::getAlgorithm(
+      std::vector<TIndex>(1, 3), std::vector<TIndex>(2, 7), []() { return 10; });
+
+  EXPECT_EQ(res2, 5);
+}
+
+TEST(SharedAlgorithmsCacheTest, KeysDifferBySplitPoint) {
+  int result = SharedAlgorithmsCache<int>::getAlgorithm(
+      std::vector<TIndex>(2, 11), std::vector<TIndex>(1, 11), []() {
+        return 5;
+      });
+  EXPECT_EQ(result, 5);
+
+  int res2 = SharedAlgorithmsCache<int>::getAlgorithm(
+      std::vector<TIndex>(1, 11), std::vector<TIndex>(2, 11), []() {
+        return 10;
+      });
+
+  EXPECT_EQ(res2, 10);
+}
+
 } // namespace caffe2
@@ -214,6 +214,26 @@ class CudnnConvOpBase : public ConvPoolOpBase<CUDAContext> {
     }
   }
 
+  // Everything besides the input shape that affects which algorithm the
+  // exhaustive search picks, so that the result can be shared among all
+  // operators with the same convolution configuration.
+  template <typename T_X, typename T_W, typename MATH>
+  vector<TIndex> AlgorithmsCacheKey(const vector<TIndex>& filter_dims) {
+    vector<TIndex> key(filter_dims);
+    key.insert(key.end(), stride_.begin(), stride_.end());
+    key.insert(key.end(), pads_.begin(), pads_.end());
+    key.insert(key.end(), dilation_.begin(), dilation_.end());
+    key.push_back(group_);
+    key.push_back(static_cast<TIndex>(order_));
+    key.push_back(enable_tensor_core_);
+    key.push_back(sizeof(T_X));
+    key.push_back(sizeof(T_W));
+    key.push_back(sizeof(MATH));
+    key.push_back(cudnn_ws_nbytes_limit_);
+    key.push_back(context_.cuda_gpu_id());
+    return key;
+  }
+
   vector<TIndex> cudnn_input_dims_;
   vector<TIndex> cudnn_filter_dims_;
 
@@ -249,7 +269,6 @@ class CudnnConvOp final : public CudnnConvOpBase {
 
  private:
   cudnnConvolutionFwdAlgo_t algo_;
-  AlgorithmsCache<cudnnConvolutionFwdAlgo_t> algo_cache_;
   // Input: X, W, b
   // Output: Y
   INPUT_TAGS(INPUT, FILTER, BIAS);
@@ -277,8 +296,6 @@ class CudnnConvGradientOp final : public CudnnConvOpBase {
  private:
   cudnnConvolutionBwdFilterAlgo_t bwd_filter_algo_;
   cudnnConvolutionBwdDataAlgo_t bwd_data_algo_;
-  AlgorithmsCache<cudnnConvolutionBwdFilterAlgo_t> filter_algo_cache_;
-  AlgorithmsCache<cudnnConvolutionBwdDataAlgo_t> data_algo_cache_;
   bool no_bias_;
   // input: X, W, dY
   // output: dW, db, and optionally dX
@@ -506,7 +523,10 @@ bool CudnnConvOp::DoRunWithType() {
     } else if (deterministic_) {
       algo_ = CUDNN_CONVOLUTION_FWD_ALGO_IMPLICIT_PRECOMP_GEMM;
     } else if (exhaustive_search_) {
-      algo_ = algo_cache_.getAlgorithm(X.dims(), filter.dims(), [&]() {
+      algo_ = SharedAlgorithmsCache<cudnnConvolutionFwdAlgo_t>::getAlgorithm(
+          X.dims(),
+          AlgorithmsCacheKey<T_X, T_W, MATH>(filter.dims()),
+          [&]() {
         VLOG(1) << "CUDNN Convolution: doing exhaustive search.";
         // When we do an exhaustive search, we will ignore the workspace size
         // limit and simply go for the fastest algorithm. If you happen to run
@@ -532,6 +552,9 @@ bool CudnnConvOp::DoRunWithType() {
               perf_stat.data(),
               state->workspace().get(cudnn_ws_nbytes_limit_),
               cudnn_ws_nbytes_limit_));
+          // Give back the search-sized buffer; the shared workspace only
+          // grows again to what the chosen algorithms actually need.
+          state->workspace().reset();
         });
         LogCuDNNPerfStats(perf_stat, returned_algo_count);
         return perf_stat[0].algo;
@@ -874,7 +897,10 @@ bool CudnnConvGradientOp::DoRunWithType() {
       bwd_filter_algo_ = CUDNN_CONVOLUTION_BWD_FILTER_ALGO_1;
     } else if (exhaustive_search_) {
       bwd_filter_algo_ =
-          filter_algo_cache_.getAlgorithm(X.dims(), filter.dims(), [&]() {
+          SharedAlgorithmsCache<cudnnConvolutionBwdFilterAlgo_t>::getAlgorithm(
+              X.dims(),
+              AlgorithmsCacheKey<T_X, T_W, MATH>(filter.dims()),
+              [&]() {
             VLOG(1) << "CUDNN Convolution bwd: doing filter exhaustive search.";
             // When we do an exhaustive search, we will ignore the workspace
             // size
@@ -906,6 +932,7 @@ bool CudnnConvGradientOp::DoRunWithType() {
                       filter_perf_stat.data(),
                       state->workspace().get(cudnn_ws_nbytes_limit_),
                       cudnn_ws_nbytes_limit_));
+                  state->workspace().reset();
                 });
             LogCuDNNPerfStats(filter_perf_stat, returned_algo_count);
             return filter_perf_stat[0].algo;
@@ -930,7 +957,10 @@ bool CudnnConvGradientOp::DoRunWithType() {
         bwd_data_algo_ = CUDNN_CONVOLUTION_BWD_DATA_ALGO_1;
       } else if (exhaustive_search_) {
         bwd_data_algo_ =
-            data_algo_cache_.getAlgorithm(X.dims(), filter.dims(), [&]() {
+            SharedAlgorithmsCache<cudnnConvolutionBwdDataAlgo_t>::getAlgorithm(
+                X.dims(),
+                AlgorithmsCacheKey<T_X, T_W, MATH>(filter.dims()),
+                [&]() {
               VLOG(1) << "CUDNN Convolution bwd: doing data exhaustive search.";
               int returned_algo_count;
 
@@ -960,6 +990,7 @@ bool CudnnConvGradientOp::DoRunWithType() {
                         data_perf_stat.data(),
                         state->workspace().get(cudnn_ws_nbytes_limit_),
                         cudnn_ws_nbytes_limit_));
+                    state->workspace().reset();
                   });
 
               LogCuDNNPerfStats(data_perf_stat, returned_algo_count);
@@ -18,6 +18,7 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+from caffe2.proto import caffe2_pb2
 from caffe2.python import brew, core, scope, workspace
 from caffe2.python.modeling.parameter_info import ParameterTags
 from caffe2.python.model_helper import ModelHelper
@@ -85,6 +86,34 @@ class BrewTest(unittest.TestCase):
         neg = workspace.FetchBlob("out_xneg")
         self.assertAlmostEqual(neg.mean(), 0)
 
+    def test_cnn_model_helper_fuse_for_inference_run_all_on_gpu(self):
+        model = CNNModelHelper(
+            name="test_model", order='NCHW', use_gpu_engine=False)
+        model.Conv("x", "conv", 3, 5, 3, pad=1)
+        model.SpatialBN("conv", "bn", 5, is_test=True)
+        model.param_init_net.RunAllOnGPU()
+        model.net.RunAllOnGPU()
+
+        workspace.FeedBlob(
+            "x", np.random.rand(4, 3, 8, 8).astype(np.float32) - 0.5,
+            device_option=model.GPU)
+        workspace.RunNetOnce(model.param_init_net)
+        for suffix in ["_s", "_b", "_rm"]:
+            workspace.FeedBlob(
+                "bn" + suffix, np.random.rand(5).astype(np.float32) - 0.5,
+                device_option=model.GPU)
+        workspace.FeedBlob(
+            "bn_riv", np.random.rand(5).astype(np.float32) + 0.5,
+            device_option=model.GPU)
+        workspace.RunNetOnce(model.net)
+        expected = workspace.FetchBlob("bn")
+
+        model.FuseForInference()
+        self.assertEqual([op.type for op in model.net.Proto().op], ["Conv"])
+        workspace.RunNetOnce(model.net)
+        np.testing.assert_allclose(
+            workspace.FetchBlob("bn"), expected, rtol=1e-4, atol=1e-4)
+
     def test_tanh(self):
         X = np.ones((5, 5)).astype(np.float32) - 0.5
 
@@ -211,6 +240,207 @@ class BrewTest(unittest.TestCase):
         # covering some CNNModelHelper logic
         model = CNNModelHelper(name="test_model", order='NHWC')
         self.assertEqual(model.arg_scope['order'], 'NHWC')
+        self.assertIs(model.CPU, model.CPU)
+        self.assertIs(model.GPU, model.gpu(0))
+        self.assertIsNot(model.gpu(0), model.gpu(1))
+
+    def test_cnn_model_helper_order(self):
+        self.assertEqual(CNNModelHelper(force_nchw=True).order, 'NCHW')
+        self.assertEqual(
+            CNNModelHelper(order='NHWC', force_nchw=True).order, 'NHWC')
+        self.assertEqual(CNNModelHelper(order='NCHW').order, 'NCHW')
+        self.assertEqual(CNNModelHelper(use_gpu_engine=False).order, 'NCHW')
+        with core.DeviceScope(core.DeviceOption(caffe2_pb2.CPU)):
+            self.assertEqual(CNNModelHelper().order, 'NCHW')
+        with self.assertRaises(ValueError):
+            CNNModelHelper(order='NCWH')
+
+    def test_lrn_gpu_engine_order(self):
+        gpu_engine = 'MIOPEN' if workspace.has_hip else 'CUDNN'
+        for order, engine in [('NCHW', gpu_engine), ('NHWC', '')]:
+            model = ModelHelper(name="test_model")
+            with core.DeviceScope(core.DeviceOption(caffe2_pb2.CUDA, 0)):
+                brew.lrn(model, "x", "out", order=order, use_gpu_engine=True,
+                         size=5)
+            op, = model.net.Proto().op
+            self.assertEqual(op.engine, engine)
+
+    def test_max_pool_with_index_order(self):
+        model = ModelHelper(name="test_model")
+        brew.max_pool_with_index(
+            model, "x", "out", order="NCHW", kernel=2, stride=2)
+        op, = model.net.Proto().op
+        self.assertEqual(op.type, "MaxPoolWithIndex")
+        self.assertEqual(list(op.output), ["out", "out_index"])
+        with self.assertRaises(ValueError):
+            brew.max_pool_with_index(
+                model, "x", "out2", order="NHWC", kernel=2, stride=2)
+        with self.assertRaises(ValueError):
+            CNNModelHelper(name="test_model", order='NHWC').MaxPoolWithIndex(
+                "x", "out", kernel=2, stride=2)
+
+    def test_cnn_model_helper_image_input_gpu_transform(self):
+        def uses_gpu_transform(device_type, **kwargs):
+            model = CNNModelHelper(name="test_model", order='NCHW')
+            with core.DeviceScope(core.DeviceOption(device_type, 0)):
+                model.ImageInput(
+                    "reader", ["data", "label"], is_test=0, **kwargs)
+            return [op.type for op in model.net.Proto().op] == ["ImageInput"]
+
+        self.assertTrue(uses_gpu_transform(caffe2_pb2.CUDA))
+        self.assertFalse(uses_gpu_transform(caffe2_pb2.CPU))
+        self.assertFalse(uses_gpu_transform(caffe2_pb2.CUDA, color_jitter=1))
+        self.assertFalse(
+            uses_gpu_transform(caffe2_pb2.CUDA, color_lighting=1))
+        self.assertFalse(
+            uses_gpu_transform(caffe2_pb2.CUDA, use_gpu_transform=False))
+        self.assertFalse(uses_gpu_transform(
+            caffe2_pb2.CUDA,
+            device_option=core.DeviceOption(caffe2_pb2.CPU)))
+        self.assertTrue(uses_gpu_transform(
+            caffe2_pb2.CPU,
+            device_option=core.DeviceOption(caffe2_pb2.CUDA, 0)))
+
+    @unittest.skipIf(workspace.has_hip, "force_algo_fwd is cuDNN only")
+    def test_cnn_model_helper_conv_algo_preference(self):
+        model = CNNModelHelper(
+            name="test_model", order='NCHW', conv_algo_preference="winograd")
+        model.Conv("x", "conv1", 3, 16, 3, ('XavierFill', {}),
+                   ('ConstantFill', {}), pad=1)
+        model.Conv("conv1", "conv2", 16, 16, 3, stride=2)
+        model.Conv("conv2", "conv3", 16, 16, kernel=3, group=2)
+        model.Conv("conv3", "conv4", 16, 16, 3, strides=[2, 2])
+        model.Conv("conv4", "conv5", 16, 16, 3, dilations=[2, 2])
+        model.Conv("conv5", "conv6", 16, 16, 3, strides=[1, 1])
+
+        def force_algo_fwd(op):
+            return [arg.i for arg in op.arg if arg.name == "force_algo_fwd"]
+
+        conv1, conv2, conv3, conv4, conv5, conv6 = model.net.Proto().op
+        self.assertEqual(force_algo_fwd(conv1), [7])
+        self.assertEqual(force_algo_fwd(conv2), [])
+        self.assertEqual(force_algo_fwd(conv3), [])
+        self.assertEqual(force_algo_fwd(conv4), [])
+        self.assertEqual(force_algo_fwd(conv5), [])
+        self.assertEqual(force_algo_fwd(conv6), [7])
+
+        # Per-call order and engine settings take precedence over the model.
+        args = ("x", "conv", 3, 16, 3)
+        self.assertEqual(model._PreferredConvAlgo(args, {}), 7)
+        self.assertIsNone(model._PreferredConvAlgo(args, {'order': 'NHWC'}))
+        self.assertIsNone(
+            model._PreferredConvAlgo(args, {'use_gpu_engine': False}))
+
+        # Weight and bias inits passed positionally still work with "auto".
+        model = CNNModelHelper(name="test_model", order='NCHW')
+        model.Conv("x", "conv", 3, 64, 11, ('XavierFill', {}),
+                   ('ConstantFill', {}), stride=4)
+        conv, = model.net.Proto().op
+        self.assertEqual(force_algo_fwd(conv), [])
+
+    def test_cnn_model_helper_constant_init(self):
+        model = CNNModelHelper(name="test_model", order='NCHW')
+        self.assertIs(model.ConstantInit(1.0), model.ConstantInit(1.0))
+        self.assertEqual(model.ConstantInit(1), ('ConstantFill', {'value': 1}))
+        value = np.array(0.5)
+        init = model.ConstantInit(value)
+        self.assertEqual(init[0], 'ConstantFill')
+        self.assertIs(init[1]['value'], value)
+        for i in range(100):
+            self.assertEqual(
+                model.ConstantInit(float(i) + 0.25)[1]['value'], i + 0.25)
+
+    def test_cnn_model_helper_half(self):
+        model = CNNModelHelper(name="test_model", order='NCHW')
+        model.CastToHalf("x", "x_fp16")
+        model.ConvHalf("x_fp16", "conv", 3, 5, 3)
+        model.CastToFloat("conv", "conv_fp32")
+
+        init_ops = [(op.type, list(op.input), list(op.output))
+                    for op in model.param_init_net.Proto().op]
+        self.assertEqual(init_ops, [
+            ("XavierFill", [], ["conv_w_fp32"]),
+            ("FloatToHalf", ["conv_w_fp32"], ["conv_w"]),
+            ("ConstantFill", [], ["conv_b_fp32"]),
+            ("FloatToHalf", ["conv_b_fp32"], ["conv_b"]),
+        ])
+        self.assertEqual(
+            [op.type for op in model.net.Proto().op],
+            ["FloatToHalf", "Conv", "HalfToFloat"])
+
+    def test_cnn_model_helper_dtype(self):
+        self.assertFalse(CNNModelHelper().gpu_engine_exhaustive_search)
+        self.assertTrue(
+            CNNModelHelper(dtype="float16").gpu_engine_exhaustive_search)
+        self.assertFalse(
+            CNNModelHelper(dtype="float16", use_gpu_engine=False)
+            .gpu_engine_exhaustive_search)
+        self.assertFalse(
+            CNNModelHelper(dtype="float16", gpu_engine_exhaustive_search=False)
+            .gpu_engine_exhaustive_search)
+        with self.assertRaises(ValueError):
+            CNNModelHelper(dtype="bfloat16")
+
+    def test_cnn_model_helper_fuse_for_inference(self):
+        X = np.random.rand(4, 3, 8, 8).astype(np.float32) - 0.5
+
+        workspace.FeedBlob("x", X)
+        model = CNNModelHelper(
+            name="test_model", order='NCHW', use_gpu_engine=False)
+        model.Conv("x", "conv", 3, 5, 3, pad=1)
+        model.SpatialBN("conv", "bn", 5, is_test=True, epsilon=1e-3)
+        model.Relu("bn", "relu")
+        workspace.RunNetOnce(model.param_init_net)
+        for suffix in ["_s", "_b", "_rm"]:
+            workspace.FeedBlob(
+                "bn" + suffix, np.random.rand(5).astype(np.float32) - 0.5)
+        workspace.FeedBlob(
+            "bn_riv", np.random.rand(5).astype(np.float32) + 0.5)
+        workspace.RunNetOnce(model.net)
+        expected = workspace.FetchBlob("relu")
+
+        model.FuseForInference()
+        self.assertEqual(
+            [op.type for op in model.net.Proto().op], ["Conv", "Relu"])
+        workspace.RunNetOnce(model.net)
+        np.testing.assert_allclose(
+            workspace.FetchBlob("relu"), expected, rtol=1e-4, atol=1e-4)
+
+    def test_cnn_model_helper_cudnn_benchmark(self):
+        model = CNNModelHelper(name="test_model", order='NCHW')
+        with model.cudnn_benchmark():
+            model.Conv("x", "conv1", 3, 5, 3)
+        model.Conv("conv1", "conv2", 5, 5, 3)
+
+        def exhaustive_search(op):
+            return [arg.i for arg in op.arg if arg.name == "exhaustive_search"]
+
+        model.gpu_engine_exhaustive_search = True
+        model.Conv("conv2", "conv3", 5, 5, 3)
+
+        conv1, conv2, conv3 = model.net.Proto().op
+        self.assertEqual(exhaustive_search(conv1), [1])
+        self.assertEqual(exhaustive_search(conv2), [0])
+        self.assertEqual(exhaustive_search(conv3), [1])
+
+    def test_cnn_model_helper_fuse_sum_relu(self):
+        workspace.FeedBlob("a", np.random.rand(4, 5).astype(np.float32) - 0.5)
+        workspace.FeedBlob("b", np.random.rand(4, 5).astype(np.float32) - 0.5)
+        model = CNNModelHelper(
+            name="test_model", order='NCHW', use_gpu_engine=False)
+        model.Sum(["a", "b"], "sum")
+        model.Relu("sum", "relu")
+        model.SumRelu(["a", "b"], "sum_relu")
+        workspace.RunNetOnce(model.net)
+        expected = workspace.FetchBlob("relu")
+        np.testing.assert_allclose(workspace.FetchBlob("sum_relu"), expected)
+
+        model.FuseForInference()
+        for op in model.net.Proto().op:
+            if op.type == "Relu":
+                self.assertEqual(op.input[0], op.output[0])
+        workspace.RunNetOnce(model.net)
+        np.testing.assert_allclose(workspace.FetchBlob("relu"), expected)
 
     def test_get_params(self):
         def param(x):
@@ -329,6 +559,34 @@ class BrewGPUTest(unittest.TestCase):
         neg = workspace.FetchBlob("out_xneg")
         self.assertAlmostEqual(neg.mean(), 0)
 
+    def test_cnn_model_helper_fuse_for_inference_run_all_on_gpu(self):
+        model = CNNModelHelper(
+            name="test_model", order='NCHW', use_gpu_engine=False)
+        model.Conv("x", "conv", 3, 5, 3, pad=1)
+        model.SpatialBN("conv", "bn", 5, is_test=True)
+        model.param_init_net.RunAllOnGPU()
+        model.net.RunAllOnGPU()
+
+        workspace.FeedBlob(
+            "x", np.random.rand(4, 3, 8, 8).astype(np.float32) - 0.5,
+            device_option=model.GPU)
+        workspace.RunNetOnce(model.param_init_net)
+        for suffix in ["_s", "_b", "_rm"]:
+            workspace.FeedBlob(
+                "bn" + suffix, np.random.rand(5).astype(np.float32) - 0.5,
+                device_option=model.GPU)
+        workspace.FeedBlob(
+            "bn_riv", np.random.rand(5).astype(np.float32) + 0.5,
+            device_option=model.GPU)
+        workspace.RunNetOnce(model.net)
+        expected = workspace.FetchBlob("bn")
+
+        model.FuseForInference()
+        self.assertEqual([op.type for op in model.net.Proto().op], ["Conv"])
+        workspace.RunNetOnce(model.net)
+        np.testing.assert_allclose(
+            workspace.FetchBlob("bn"), expected, rtol=1e-4, atol=1e-4)
+
     def test_tanh(self):
         X = np.ones((5, 5)).astype(np.float32) - 0.5
 
@@ -20,29 +20,174 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
-from caffe2.python import brew, workspace
+from caffe2.python import brew, scope, workspace
 from caffe2.python.model_helper import ModelHelper
+from caffe2.python.modeling.initializers import pFP16Initializer
 from caffe2.proto import caffe2_pb2
+import contextlib
 import logging
+import numpy as np
+
+
+# Initializers handed out by CNNModelHelper. They are shared between all
+# callers, so the kwargs dicts must not be modified.
+_XAVIER_INIT = ('XavierFill', {})
+_MSRA_INIT = ('MSRAFill', {})
+_ZERO_INIT = ('ConstantFill', {})
+# ConstantInit tuples, keyed by the type and value of the constant. Once
+# full, new values are no longer cached.
+_CONSTANT_INITS = {}
+_CONSTANT_INITS_MAXSIZE = 64
+
+# The deprecation warning is only logged for the first CNNModelHelper.
+_DEPRECATION_WARNED = False
+
+# ImageInput arguments that only take effect with the CPU image transform.
+_CPU_ONLY_IMAGE_AUGMENTATIONS = (
+    'color_jitter', 'img_saturation', 'img_brightness', 'img_contrast',
+    'color_lighting',
+)
+
+# Values of cudnnConvolutionFwdAlgo_t, passed to the CUDNN Conv op as
+# force_algo_fwd. "auto" leaves the choice to cuDNN (heuristics, or the
+# exhaustive search when gpu_engine_exhaustive_search is set).
+_CONV_ALGO_PREFERENCES = {
+    "auto": None,
+    # CUDNN_CONVOLUTION_FWD_ALGO_IMPLICIT_PRECOMP_GEMM
+    "implicit_precomp_gemm": 1,
+    # CUDNN_CONVOLUTION_FWD_ALGO_FFT_TILING
+    "fft_tiling": 5,
+    # CUDNN_CONVOLUTION_FWD_ALGO_WINOGRAD_NONFUSED
+    "winograd": 7,
+}
+
+
+def _GetDefaultOrder(use_gpu_engine):
+    """Picks NHWC when convolutions will run on a Tensor Core capable cuDNN
+    (cuDNN >= 7 on a Volta or newer device), NCHW otherwise. An explicit
+    device scope decides which device is checked; a CPU scope means NCHW.
+    """
+    if not use_gpu_engine or not workspace.has_gpu_support or workspace.has_hip:
+        return "NCHW"
+    if workspace.NumCudaDevices() < 1 or workspace.GetCuDNNVersion() < 7000:
+        return "NCHW"
+    device_option = scope.CurrentDeviceScope()
+    if device_option is None:
+        gpu_id = workspace.GetDefaultGPUID()
+    elif device_option.device_type == caffe2_pb2.CUDA:
+        gpu_id = device_option.cuda_gpu_id
+    else:
+        return "NCHW"
+    properties = workspace.GetDeviceProperties(gpu_id)
+    if properties is None or properties['major'] < 7:
+        return "NCHW"
+    return "NHWC"
+
+
+def _GetArgs(op):
+    return {arg.name: arg for arg in op.arg}
+
+
+def _CanFoldSpatialBN(conv, bn, consumers, external_outputs):
+    if bn.type != "SpatialBN" or len(bn.output) != 1:
+        return False
+    bn_args = _GetArgs(bn)
+    if "is_test" not in bn_args or not bn_args["is_test"].i:
+        return False
+    conv_out = conv.output[0]
+    if bn.input[0] != conv_out or consumers.get(conv_out, 0) != 1 or \
+            conv_out in external_outputs:
+        return False
+    # The parameters are rewritten in place, so they must not be shared. A
+    # conv without bias takes over the bn bias blob.
+    rewritten = list(conv.input[1:]) + (
+        [bn.input[2]] if len(conv.input) == 2 else [])
+    return all(consumers.get(blob, 0) == 1 for blob in rewritten)
+
+
+def _CanFuseSumRelu(sum_op, relu, consumers, external_outputs):
+    sum_out = sum_op.output[0]
+    return (relu.type == "Relu" and relu.input[0] == sum_out and
+            relu.output[0] != sum_out and consumers.get(sum_out, 0) == 1 and
+            sum_out not in external_outputs)
+
+
+def _FoldSpatialBN(conv, bn, net_device_option):
+    """Returns conv rewritten to also apply the test-mode bn, updating the
+    conv parameters in the workspace:
+        W' = W * scale / sqrt(var + epsilon)
+        b' = (b - mean) * scale / sqrt(var + epsilon) + bias
+    The parameters are fed on the device the conv runs on, which is the net
+    device option unless the op sets its own.
+    """
+    bn_args = _GetArgs(bn)
+    epsilon = bn_args["epsilon"].f if "epsilon" in bn_args else 1e-5
+    scale, bias, mean, var = [
+        workspace.FetchBlob(blob) for blob in bn.input[1:5]]
+    multiplier = scale / np.sqrt(var + epsilon)
+
+    weight = workspace.FetchBlob(conv.input[1])
+    dtype = weight.dtype
+    weight = weight * multiplier.reshape((-1,) + (1,) * (weight.ndim - 1))
+    if len(conv.input) > 2:
+        conv_bias = workspace.FetchBlob(conv.input[2])
+    else:
+        # Reuse the bn bias blob as the bias of the fused conv.
+        conv_bias = np.zeros_like(bias)
+        conv.input.append(bn.input[2])
+    conv_bias = (conv_bias - mean) * multiplier + bias
+
+    device_option = conv.device_option if conv.HasField('device_option') \
+        else net_device_option
+    workspace.FeedBlob(conv.input[1], weight.astype(dtype),
+                       device_option=device_option)
+    workspace.FeedBlob(conv.input[2], conv_bias.astype(dtype),
+                       device_option=device_option)
+    conv.output[0] = bn.output[0]
+    return conv
 
 
 class CNNModelHelper(ModelHelper):
     """A helper model so we can write CNN models more easily, without having to
     manually define parameter initializations and operators separately.
+
+    If order is not given, it is picked from the hardware (see
+    _GetDefaultOrder), and the weight shapes follow that order. Pass order
+    (or force_nchw=True) explicitly when the parameters have to be portable
+    across hosts.
     """
 
-    def __init__(self, order="NCHW", name=None,
-                 use_gpu_engine=True, gpu_engine_exhaustive_search=False,
+    def __init__(self, order=None, name=None,
+                 use_gpu_engine=True, gpu_engine_exhaustive_search=None,
                  ws_nbytes_limit=None, init_params=True,
                  skip_sparse_optim=False,
-                 param_model=None):
-        logging.warning(
-            "[====DEPRECATE WARNING====]: you are creating an "
-            "object from CNNModelHelper class which will be deprecated soon. "
-            "Please use ModelHelper object with brew module. For more "
-            "information, please refer to caffe2.ai and python/brew.py, "
-            "python/brew_test.py for more information."
-        )
+                 param_model=None, force_nchw=False,
+                 conv_algo_preference="auto", dtype="float32"):
+        global _DEPRECATION_WARNED
+        if not _DEPRECATION_WARNED:
+            _DEPRECATION_WARNED = True
+            logging.warning(
+                "[====DEPRECATE WARNING====]: you are creating an "
+                "object from CNNModelHelper class which will be deprecated "
+                "soon. Please use ModelHelper object with brew module. For "
+                "more information, please refer to caffe2.ai and "
+                "python/brew.py, python/brew_test.py for more information."
+            )
+
+        # When no order is given, default to NHWC on Tensor Core GPUs so the
+        # cuDNN kernels do not need NCHW <-> NHWC transposes. Pass
+        # force_nchw=True to keep the old NCHW default.
+        if order is None:
+            order = "NCHW" if force_nchw else _GetDefaultOrder(use_gpu_engine)
+        # dtype only picks the default of gpu_engine_exhaustive_search: for
+        # fp16 models the exhaustive search pays off the most, as the cuDNN
+        # heuristics often miss the Tensor Core algorithms. Use ConvHalf to
+        # actually build fp16 convolutions.
+        if dtype not in ("float32", "float16"):
+            raise ValueError("Cannot understand the CNN dtype %s." % dtype)
+        if gpu_engine_exhaustive_search is None:
+            gpu_engine_exhaustive_search = (
+                dtype == "float16" and bool(use_gpu_engine))
 
         cnn_arg_scope = {
             'order': order,
@@ -63,12 +208,40 @@ class CNNModelHelper(ModelHelper):
         self.use_gpu_engine = use_gpu_engine
         self.gpu_engine_exhaustive_search = gpu_engine_exhaustive_search
         self.ws_nbytes_limit = ws_nbytes_limit
-        if self.order != "NHWC" and self.order != "NCHW":
+        self.conv_algo_preference = conv_algo_preference
+        if self.conv_algo_preference not in _CONV_ALGO_PREFERENCES:
+            raise ValueError(
+                "Cannot understand the conv algorithm preference %s." %
+                self.conv_algo_preference
+            )
+        if self.order not in ("NCHW", "NHWC"):
             raise ValueError(
                 "Cannot understand the CNN storage order %s." % self.order
             )
 
-    def ImageInput(self, blob_in, blob_out, use_gpu_transform=False, **kwargs):
+        # DeviceOption protos are expensive to build in Python and the CPU /
+        # GPU properties are read once per op in device scopes, so cache them.
+        self._cpu_device_option = caffe2_pb2.DeviceOption(
+            device_type=caffe2_pb2.CPU)
+        self._gpu_device_options = {}
+        self.gpu(0)
+
+    @contextlib.contextmanager
+    def cudnn_benchmark(self, enabled=True):
+        """Overrides gpu_engine_exhaustive_search for the convolutions created
+        within the scope, so that the exhaustive algorithm search can be
+        limited to the parts of the model with fixed input shapes.
+        """
+        old_enabled = self.gpu_engine_exhaustive_search
+        self.gpu_engine_exhaustive_search = enabled
+        try:
+            yield
+        finally:
+            self.gpu_engine_exhaustive_search = old_enabled
+
+    def ImageInput(self, blob_in, blob_out, use_gpu_transform=None, **kwargs):
+        if use_gpu_transform is None:
+            use_gpu_transform = self._CanUseGPUTransform(kwargs)
         return brew.image_input(
             self,
             blob_in,
@@ -78,6 +251,19 @@ class CNNModelHelper(ModelHelper):
             **kwargs
         )
 
+    def _CanUseGPUTransform(self, kwargs):
+        """The GPU transform only produces NCHW, needs the op to run on the
+        GPU, and does not implement the color augmentations.
+        """
+        device_option = kwargs['device_option'] if 'device_option' in kwargs \
+            else scope.CurrentDeviceScope()
+        return (
+            self.use_gpu_engine and self.order == "NCHW" and
+            device_option is not None and
+            device_option.device_type in (caffe2_pb2.CUDA, caffe2_pb2.HIP) and
+            not any(kwargs.get(arg) for arg in _CPU_ONLY_IMAGE_AUGMENTATIONS)
+        )
+
     def VideoInput(self, blob_in, blob_out, **kwargs):
         return brew.video_input(
             self,
@@ -102,6 +288,10 @@ class CNNModelHelper(ModelHelper):
         )
 
     def Conv(self, *args, **kwargs):
+        if self.conv_algo_preference != "auto":
+            algo = self._PreferredConvAlgo(args, kwargs)
+            if algo is not None:
+                kwargs['force_algo_fwd'] = algo
         return brew.conv(
             self,
             *args,
@@ -112,6 +302,54 @@ class CNNModelHelper(ModelHelper):
             **kwargs
         )
 
+    def _PreferredConvAlgo(self, args, kwargs):
+        """Returns the cuDNN forward algorithm to force for a 2D convolution
+        according to conv_algo_preference, or None to let cuDNN choose.
+        args and kwargs are the arguments of brew.conv after the model.
+        """
+        if (self.conv_algo_preference == "auto" or workspace.has_hip or
+                not kwargs.get('use_gpu_engine', self.use_gpu_engine) or
+                kwargs.get('order', self.order) != "NCHW"):
+            return None
+        if any(arg in kwargs for arg in
+                ('engine', 'deterministic', 'force_algo', 'force_algo_fwd')):
+            return None
+        if self.conv_algo_preference == "implicit_precomp_gemm":
+            return _CONV_ALGO_PREFERENCES["implicit_precomp_gemm"]
+        # Positions in brew.conv(model, blob_in, blob_out, dim_in, dim_out,
+        # kernel, weight_init, bias_init, WeightInitializer,
+        # BiasInitializer, group, ...).
+        kernel = args[4] if len(args) > 4 else kwargs.get('kernel')
+        group = args[9] if len(args) > 9 else kwargs.get('group', 1)
+        if kernel is None:
+            return None
+        kernel = kernel if isinstance(kernel, list) else [kernel] * 2
+        # Winograd and FFT tiling are only implemented for unit strides
+        # and dilations.
+        for arg in ('stride', 'stride_h', 'stride_w', 'dilation',
+                    'dilation_h', 'dilation_w'):
+            if kwargs.get(arg, 1) != 1:
+                return None
+        for arg in ('strides', 'dilations'):
+            if any(value != 1 for value in kwargs.get(arg, ())):
+                return None
+        if self.conv_algo_preference == "winograd":
+            if kernel == [3, 3] and group == 1:
+                return _CONV_ALGO_PREFERENCES["winograd"]
+        elif self.conv_algo_preference == "fft_tiling":
+            if min(kernel) >= 5:
+                return _CONV_ALGO_PREFERENCES["fft_tiling"]
+        return None
+
+    def ConvHalf(self, *args, **kwargs):
+        """Conv on float16 inputs, with the parameters kept as float16 copies
+        of float32 master blobs. Its output can go straight into SpatialBN,
+        which takes float16 inputs with float32 parameters on CUDA.
+        """
+        kwargs.setdefault('WeightInitializer', pFP16Initializer)
+        kwargs.setdefault('BiasInitializer', pFP16Initializer)
+        return self.Conv(*args, **kwargs)
+
     def ConvTranspose(self, *args, **kwargs):
         return brew.conv_transpose(
             self,
@@ -176,6 +414,12 @@ class CNNModelHelper(ModelHelper):
     def SpatialBN(self, *args, **kwargs):
         return brew.spatial_bn(self, *args, order=self.order, **kwargs)
 
+    def CastToHalf(self, blob_in, blob_out, **kwargs):
+        return self.net.FloatToHalf(blob_in, blob_out, **kwargs)
+
+    def CastToFloat(self, blob_in, blob_out, **kwargs):
+        return self.net.HalfToFloat(blob_in, blob_out, **kwargs)
+
     def InstanceNorm(self, *args, **kwargs):
         return brew.instance_norm(self, *args, order=self.order, **kwargs)
 
@@ -198,6 +442,12 @@ class CNNModelHelper(ModelHelper):
     def Sum(self, *args, **kwargs):
         return brew.sum(self, *args, **kwargs)
 
+    def SumRelu(self, blob_in, blob_out, **kwargs):
+        """Sum followed by a Relu that runs in place on the sum, so that no
+        separate blob is materialized for the pre-activation.
+        """
+        return self.Relu(self.Sum(blob_in, blob_out, **kwargs), blob_out)
+
     def Transpose(self, *args, **kwargs):
         return brew.transpose(self, *args, use_gpu_engine=self.use_gpu_engine, **kwargs)
 
@@ -220,38 +470,89 @@ class CNNModelHelper(ModelHelper):
             self, *args, use_gpu_engine=self.use_gpu_engine, order=self.order, **kwargs
         )
 
-    @property
-    def XavierInit(self):
-        return ('XavierFill', {})
+    XavierInit = _XAVIER_INIT
 
     def ConstantInit(self, value):
-        return ('ConstantFill', dict(value=value))
-
-    @property
-    def MSRAInit(self):
-        return ('MSRAFill', {})
-
-    @property
-    def ZeroInit(self):
-        return ('ConstantFill', {})
+        key = (type(value), value)
+        try:
+            init = _CONSTANT_INITS.get(key)
+        except TypeError:
+            # Unhashable values, e.g. 0-d numpy arrays, are not cached.
+            return ('ConstantFill', dict(value=value))
+        if init is None:
+            init = ('ConstantFill', dict(value=value))
+            if len(_CONSTANT_INITS) < _CONSTANT_INITS_MAXSIZE:
+                _CONSTANT_INITS[key] = init
+        return init
+
+    MSRAInit = _MSRA_INIT
+
+    ZeroInit = _ZERO_INIT
 
     def AddWeightDecay(self, weight_decay):
         return brew.add_weight_decay(self, weight_decay)
 
+    def FuseForInference(self):
+        """Rewrites the net for inference by folding every test-mode SpatialBN
+        into the Conv that feeds it, and by making every Relu that directly
+        follows a Sum run in place on the Sum output.
+
+        The folded weights and biases are written back to the current
+        workspace, so the parameters have to be initialized (or loaded)
+        before calling this, and the net must not be trained afterwards.
+        """
+        net_proto = self.net.Proto()
+        ops = net_proto.op
+        consumers = {}
+        for op in ops:
+            for blob in op.input:
+                consumers[blob] = consumers.get(blob, 0) + 1
+        external_outputs = set(net_proto.external_output)
+
+        fused_ops = []
+        i = 0
+        while i < len(ops):
+            op = ops[i]
+            next_op = ops[i + 1] if i + 1 < len(ops) else None
+            if (op.type == "Conv" and next_op is not None and
+                    _CanFoldSpatialBN(op, next_op, consumers,
+                                      external_outputs)):
+                fused_ops.append(
+                    _FoldSpatialBN(op, next_op, net_proto.device_option))
+                i += 2
+            elif (op.type == "Sum" and next_op is not None and
+                    _CanFuseSumRelu(op, next_op, consumers, external_outputs)):
+                op.output[0] = next_op.output[0]
+                next_op.input[0] = next_op.output[0]
+                fused_ops.extend([op, next_op])
+                i += 2
+            else:
+                fused_ops.append(op)
+                i += 1
+
+        del ops[:]
+        ops.extend(fused_ops)
+
     @property
     def CPU(self):
-        device_option = caffe2_pb2.DeviceOption()
-        device_option.device_type = caffe2_pb2.CPU
-        return device_option
+        return self._cpu_device_option
 
     @property
-    def GPU(self, gpu_id=0):
-
-        device_option = caffe2_pb2.DeviceOption()
-        if workspace.has_hip:
-            device_option.device_type = caffe2_pb2.HIP
-            device_option.hip_gpu_id = gpu_id
-        else:
-            device_option.device_type = caffe2_pb2.CUDA
-            device_option.cuda_gpu_id = gpu_id
+    def GPU(self):
+        return self.gpu(0)
+
+    def gpu(self, gpu_id=0):
+        """Returns the (cached) DeviceOption of the given GPU. The returned
+        proto is shared, so copy it before modifying it.
+        """
+        device_option = self._gpu_device_options.get(gpu_id)
+        if device_option is None:
+            device_option = caffe2_pb2.DeviceOption()
+            if workspace.has_hip:
+                device_option.device_type = caffe2_pb2.HIP
+                device_option.hip_gpu_id = gpu_id
+            else:
+                device_option.device_type = caffe2_pb2.CUDA
+                device_option.cuda_gpu_id = gpu_id
+            self._gpu_device_options[gpu_id] = device_option
         return device_option
@@ -32,7 +32,10 @@ def lrn(model, blob_in, blob_out, order="NCHW", use_gpu_engine=False, **kwargs):
     dev = kwargs['device_option'] if 'device_option' in kwargs \
         else scope.CurrentDeviceScope()
     is_cpu = dev is None or dev.device_type == caffe2_pb2.CPU
-    if use_gpu_engine and (not is_cpu):
+    # The CUDNN and MIOPEN LRN ops always treat the input as NCHW, so NHWC
+    # inputs have to go through the default GPU implementation.
+    use_engine = use_gpu_engine and (not is_cpu) and order == "NCHW"
+    if use_engine:
         kwargs['engine'] = 'MIOPEN' if has_hip else 'CUDNN'
         blobs_out = blob_out
     else:
@@ -44,7 +47,7 @@ def lrn(model, blob_in, blob_out, order="NCHW", use_gpu_engine=False, **kwargs):
         **kwargs
     )
 
-    if use_gpu_engine and (not is_cpu):
+    if use_engine:
         return lrn
     else:
         return lrn[0]
@@ -46,6 +46,10 @@ def average_pool(model, blob_in, blob_out, use_gpu_engine=False, order="NCHW",
 
 def max_pool_with_index(model, blob_in, blob_out, order="NCHW", **kwargs):
     """Max pooling with an explicit index of max position"""
+    # The (CUDA only) MaxPoolWithIndex op always indexes its input as NCHW.
+    if order != "NCHW":
+        raise ValueError(
+            "MaxPoolWithIndex only supports NCHW, got order %s." % order)
     return model.net.MaxPoolWithIndex(
         blob_in,
         [blob_out, blob_out + "_index"],